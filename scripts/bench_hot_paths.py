@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""Scale benchmarks for the local (non-network) hot paths of the web backend.
+
+Builds synthetic dishes/ folders, upload histories, menu replies and upload
+files at each requested size in a temporary directory, times the backend
+functions against them and writes the results as JSON.
+
+Usage:
+    python scripts/bench_hot_paths.py --sizes 10000,100000 --output bench_results.json
+    python scripts/bench_hot_paths.py --module app_production
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'src', 'web'))
+
+ADJECTIVES = ['spicy', 'grilled', 'crispy', 'smoked', 'braised', 'roasted', 'steamed', 'fried', 'glazed', 'stuffed']
+NOUNS = ['chicken', 'tofu', 'noodles', 'dumplings', 'salmon', 'pork belly', 'lamb', 'tacos', 'curry', 'risotto']
+
+
+def synthetic_dish(rng, index):
+    return f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {index}"
+
+
+def time_call(func, repeat):
+    """Run func repeat times and return timing statistics in seconds"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return {
+        'repeat': repeat,
+        'min_s': min(timings),
+        'median_s': statistics.median(timings),
+        'mean_s': statistics.mean(timings),
+    }
+
+
+def build_dishes_folder(folder, size, rng):
+    """Fill folder with size empty images in the new, legacy and tiered naming formats"""
+    dishes = []
+    for index in range(size):
+        dish = synthetic_dish(rng, index)
+        dishes.append(dish)
+        kind = index % 3
+        if kind == 0:
+            filename = f"{dish.replace(' ', '_').lower()}.png"
+        elif kind == 1:
+            filename = f"{dish.replace(' ', '_')}_{index % 10}.png"
+        else:
+            filename = f"{dish.replace(' ', '_').lower()}__draft__photo.png"
+        open(os.path.join(folder, filename), 'wb').close()
+    return dishes
+
+
+def build_history(size, rng):
+    """Upload history with size entries of roughly menu-sized dish lists"""
+    history = {}
+    for index in range(size):
+        dishes = [synthetic_dish(rng, rng.randrange(size)) for _ in range(12)]
+        history[hashlib.sha256(str(index).encode()).hexdigest()] = {
+            'filename': f"menu_{index}.jpg",
+            'dishes': dishes,
+            'generated_images': [
+                {'dish': dish, 'filename': f"{dish.replace(' ', '_')}.png", 'path': f"/image/{dish.replace(' ', '_')}.png"}
+                for dish in dishes
+            ],
+            'timestamp': time.time(),
+            'upload_count': rng.randint(1, 5),
+        }
+    return history
+
+
+def build_reply(size, rng, as_json=False):
+    """Model reply with size dishes, including chatter the parser must drop.
+
+    Plain text with one dish per line, or a fenced JSON array when as_json is set.
+    """
+    if as_json:
+        dishes = [synthetic_dish(rng, index).title() for index in range(size)]
+        return f'Here is the "menu":\n```json\n{json.dumps(dishes)}\n```'
+    lines = ['Here are the dishes from the menu:', '```plaintext']
+    for index in range(size):
+        lines.append(f"{index + 1}. {synthetic_dish(rng, index).title()}")
+    lines.append('```')
+    return '\n'.join(lines)
+
+
+def stream_reply(reply, chunk_chars=8):
+    """Split a reply into deltas of roughly streamed-token size"""
+    return [reply[i:i + chunk_chars] for i in range(0, len(reply), chunk_chars)]
+
+
+def run(module_name, sizes, repeat, hash_mb, seed):
+    backend = __import__(module_name)
+    logging.getLogger(module_name).setLevel(logging.WARNING)
+    app = backend.app
+    rng = random.Random(seed)
+    results = []
+
+    def record(name, size, stats):
+        stats.update({'name': name, 'size': size})
+        results.append(stats)
+        print(f"{name:<40} {size:>8}  median {stats['median_s'] * 1000:10.3f} ms")
+
+    workdir = tempfile.mkdtemp(prefix='menu2img-bench-')
+    try:
+        for size in sizes:
+            dishes_folder = os.path.join(workdir, f'dishes_{size}')
+            os.makedirs(dishes_folder)
+            app.config['OUTPUT_FOLDER'] = dishes_folder
+            app.config['HISTORY_FILE'] = os.path.join(workdir, f'history_{size}.json')
+
+            dishes = build_dishes_folder(dishes_folder, size, rng)
+            hit_new, hit_legacy = dishes[0], dishes[1]
+            missing = f"unlisted dish {size + 1}"
+            for name, dish in [('find_existing_image[new-format hit]', hit_new),
+                               ('find_existing_image[legacy hit]', hit_legacy),
+                               ('find_existing_image[miss]', missing)]:
+                record(name, size, time_call(lambda dish=dish: backend.find_existing_image(dish, dishes_folder), repeat))
+                if hasattr(backend, '_dish_index'):
+                    # Drop the folder listing each run to time the directory scan, not the in-memory index
+                    def cold_find(dish=dish):
+                        backend._dish_index.clear()
+                        backend.find_existing_image(dish, dishes_folder)
+                    record(name.replace(']', ' cold]'), size, time_call(cold_find, repeat))
+
+            # Parse a canned reply through the live streaming path, without the network
+            deltas = stream_reply(build_reply(size, rng, as_json=not hasattr(backend, 'clean_dish_line')))
+            completion_text = backend._hedged_completion_text
+            backend._hedged_completion_text = lambda encoded_image, prompt: iter(deltas)
+            try:
+                record('stream_dish_names', size, time_call(lambda: list(backend.stream_dish_names('', '')), repeat))
+            finally:
+                backend._hedged_completion_text = completion_text
+
+            history = build_history(size, rng)
+            record('save_upload_history', size, time_call(lambda: backend.save_upload_history(history), repeat))
+            record('load_upload_history', size, time_call(backend.load_upload_history, repeat))
+            if hasattr(backend, '_history_cache'):
+                # Force a re-parse each run to time the JSON load itself, not the in-memory cache
+                def cold_load():
+                    backend._history_cache['key'] = None
+                    backend.load_upload_history()
+                record('load_upload_history[cold]', size, time_call(cold_load, repeat))
+
+            shutil.rmtree(dishes_folder)
+
+        upload_path = os.path.join(workdir, 'upload.jpg')
+        with open(upload_path, 'wb') as f:
+            f.write(os.urandom(hash_mb * 1024 * 1024))
+        record('get_file_hash', hash_mb * 1024 * 1024, time_call(lambda: backend.get_file_hash(upload_path), repeat))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--module', default='app', choices=['app', 'app_production'], help='backend module to benchmark')
+    parser.add_argument('--sizes', default='10000,100000', help='comma-separated item counts (files, history entries, reply lines)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--hash-mb', type=int, default=16, help='size of the file hashed by get_file_hash')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic data')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the JSON results')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    results = run(args.module, sizes, args.repeat, args.hash_mb, args.seed)
+
+    report = {
+        'module': args.module,
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': sizes,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
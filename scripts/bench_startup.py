@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Time-to-ready benchmark for the backend the desktop app spawns.
+
+Starts src/web/app.py the way src/desktop/main.js does and measures the time
+until /ready answers 200. Trees from before /ready existed are counted as
+ready as soon as the server answers at all (404). Pass --ref to also measure an
+older commit for comparison.
+
+Usage:
+    python scripts/bench_startup.py --runs 5
+    python scripts/bench_startup.py --runs 5 --ref baseline --output startup_results.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_to_ready(app_path, port, env_overrides, timeout):
+    """Spawn the backend and return seconds until /ready answers"""
+    env = dict(os.environ, PORT=str(port), **env_overrides)
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, app_path],
+        cwd=os.path.dirname(app_path),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,  # so the reloader's child process is stopped too
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except urllib.error.HTTPError as e:
+                if e.code == 404:  # no /ready route: the server is up, which is all older trees offer
+                    return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError, OSError):
+                pass
+            time.sleep(0.01)
+        raise RuntimeError(f"{app_path} was not ready after {timeout} seconds")
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait()
+
+
+def export_ref(ref, destination):
+    """Extract src/web of a git ref into destination and return its app.py path"""
+    archive = subprocess.run(
+        ['git', 'archive', '--format=tar', ref, 'src/web'],
+        cwd=REPO_ROOT, capture_output=True, check=True
+    ).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(destination)
+    return os.path.join(destination, 'src', 'web', 'app.py')
+
+
+def measure(label, app_path, port, env_overrides, runs, timeout):
+    timings = [time_to_ready(app_path, port, env_overrides, timeout) for _ in range(runs)]
+    result = {
+        'name': label,
+        'runs': runs,
+        'min_s': min(timings),
+        'median_s': statistics.median(timings),
+        'mean_s': statistics.mean(timings),
+    }
+    print(f"{label:<32} median {result['median_s'] * 1000:8.1f} ms  (min {result['min_s'] * 1000:.1f} ms)")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help='backend starts per configuration')
+    parser.add_argument('--port', type=int, default=5051, help='port the backend listens on (older trees always use 5051)')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for a single start')
+    parser.add_argument('--ref', help='git ref to measure for comparison, e.g. a commit before /ready existed')
+    parser.add_argument('--output', default='startup_results.json', help='where to write the JSON results')
+    args = parser.parse_args()
+
+    app_path = os.path.join(REPO_ROOT, 'src', 'web', 'app.py')
+    results = [
+        measure('desktop launch (no reloader)', app_path, args.port, {'MENU2IMG_DEBUG': '0'}, args.runs, args.timeout),
+        measure('debug launch (reloader)', app_path, args.port, {'MENU2IMG_DEBUG': '1'}, args.runs, args.timeout),
+    ]
+
+    if args.ref:
+        workdir = tempfile.mkdtemp(prefix='menu2img-startup-')
+        try:
+            ref_app = export_ref(args.ref, workdir)
+            results.append(measure(f'{args.ref}', ref_app, args.port, {}, args.runs, args.timeout))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'ref': args.ref,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
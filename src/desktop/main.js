@@ -1,8 +1,12 @@
 const { app, BrowserWindow, ipcMain, dialog } = require('electron');
 const path = require('path');
 const { spawn } = require('child_process');
+const http = require('http');
 const isDev = require('electron-is-dev');
 
+const BACKEND_PORT = 5051;
+const BACKEND_URL = `http://127.0.0.1:${BACKEND_PORT}`;
+
 let mainWindow;
 let pythonProcess;
 
@@ -43,27 +47,54 @@ function createWindow() {
   }
 }
 
+// Poll the backend's readiness endpoint until it answers 200
+function waitForBackendReady(timeoutMs) {
+  const startedAt = Date.now();
+
+  return new Promise((resolve, reject) => {
+    const poll = () => {
+      const req = http.get(`${BACKEND_URL}/ready`, (res) => {
+        res.resume();
+        if (res.statusCode === 200) {
+          console.log(`Python backend ready after ${Date.now() - startedAt} ms`);
+          resolve();
+        } else {
+          retry();
+        }
+      });
+      req.on('error', retry);
+      req.setTimeout(1000, () => req.destroy());
+    };
+
+    const retry = () => {
+      if (Date.now() - startedAt > timeoutMs) {
+        reject(new Error('Python backend startup timeout'));
+      } else {
+        setTimeout(poll, 100);
+      }
+    };
+
+    poll();
+  });
+}
+
 function startPythonBackend() {
   return new Promise((resolve, reject) => {
     const pythonPath = 'python3';
     const scriptPath = path.join(__dirname, '../web/app.py');
     
     pythonProcess = spawn(pythonPath, [scriptPath], {
-      stdio: ['pipe', 'pipe', 'pipe']
+      stdio: ['pipe', 'pipe', 'pipe'],
+      // Skip the Flask reloader: it imports the whole backend a second time
+      env: { ...process.env, MENU2IMG_DEBUG: '0', PORT: String(BACKEND_PORT) }
     });
 
     pythonProcess.stdout.on('data', (data) => {
       console.log('Python stdout:', data.toString());
-      if (data.toString().includes('Running on http://127.0.0.1:5051')) {
-        resolve();
-      }
     });
 
     pythonProcess.stderr.on('data', (data) => {
       console.error('Python stderr:', data.toString());
-      if (data.toString().includes('Running on http://127.0.0.1:5051')) {
-        resolve();
-      }
     });
 
     pythonProcess.on('error', (error) => {
@@ -76,9 +107,7 @@ function startPythonBackend() {
     });
 
     // Timeout after 10 seconds
-    setTimeout(() => {
-      reject(new Error('Python backend startup timeout'));
-    }, 10000);
+    waitForBackendReady(10000).then(resolve, reject);
   });
 }
 
@@ -1,24 +1,102 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Request, Response, render_template, request, jsonify, send_file, stream_with_context
 import os
 import base64
 import requests
 import time
 from werkzeug.utils import secure_filename
 import logging
+import click
 import json
 import hashlib
+from collections import deque
+import math
+import zipfile
+import io
+import re
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class MenuRequest(Request):
+    """Request whose body limit scales with the number of menus a batch upload may carry"""
+    
+    @property
+    def max_content_length(self):
+        limit = super().max_content_length
+        if limit and self.endpoint == 'upload_batch':
+            # MAX_CONTENT_LENGTH stays the per-menu limit, enforced by upload_batch itself
+            return limit * app.config['MAX_BATCH_FILES']
+        return limit
+
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.request_class = MenuRequest
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size (per menu for batch uploads)
 
 # Use environment variables for configuration
 app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'uploads')
 app.config['OUTPUT_FOLDER'] = os.environ.get('OUTPUT_FOLDER', 'dishes')
+app.config['CACHE_FOLDER'] = os.environ.get('CACHE_FOLDER', 'cache')  # thumbnails and composites, safe to delete
 app.config['HISTORY_FILE'] = os.environ.get('HISTORY_FILE', 'upload_history.json')
+app.config['ACCESS_LOG_FILE'] = os.environ.get('ACCESS_LOG_FILE', 'image_access.json')
+app.config['CHECKPOINT_FILE'] = os.environ.get('CHECKPOINT_FILE', 'upload_checkpoints.json')
+app.config['FAILURE_CACHE_FILE'] = os.environ.get('FAILURE_CACHE_FILE', 'generation_failures.json')
+
+# Tiled extraction: split large menus into overlapping tiles extracted in parallel
+app.config['TILED_EXTRACTION'] = os.environ.get('TILED_EXTRACTION', '0') == '1'
+app.config['TILE_MIN_SIDE'] = int(os.environ.get('TILE_MIN_SIDE', 2000))  # only tile images at least this large
+app.config['TILE_SIZE'] = int(os.environ.get('TILE_SIZE', 1200))
+app.config['TILE_OVERLAP'] = float(os.environ.get('TILE_OVERLAP', 0.15))  # fraction of the tile size
+app.config['TILE_MAX_TILES'] = max(1, int(os.environ.get('TILE_MAX_TILES', 6)))  # at least one tile, or tiling never converges
+app.config['TILE_WORKERS'] = int(os.environ.get('TILE_WORKERS', 4))
+
+# Hedged extraction: when a vision call has produced nothing after the given percentile of
+# recent time-to-first-token samples, race a second request (optionally on another model)
+app.config['EXTRACTION_MODEL'] = os.environ.get('EXTRACTION_MODEL', 'gpt-4o')
+app.config['EXTRACTION_HEDGE'] = os.environ.get('EXTRACTION_HEDGE', '0') == '1'
+app.config['EXTRACTION_HEDGE_PERCENTILE'] = float(os.environ.get('EXTRACTION_HEDGE_PERCENTILE', 95))
+app.config['EXTRACTION_HEDGE_DELAY'] = float(os.environ.get('EXTRACTION_HEDGE_DELAY', 10))  # used until enough samples exist
+app.config['EXTRACTION_HEDGE_MODEL'] = os.environ.get('EXTRACTION_HEDGE_MODEL', '')  # empty = same model as the primary
+
+# Image generation pool and the shared OpenAI rate budget (token bucket)
+app.config['GENERATION_WORKERS'] = int(os.environ.get('GENERATION_WORKERS', 3))
+app.config['API_RATE_PER_MINUTE'] = float(os.environ.get('API_RATE_PER_MINUTE', 30))  # 0 disables the limit
+app.config['API_RATE_BURST'] = int(os.environ.get('API_RATE_BURST', 3))
+
+# Image quality tiers: the tier an upload aims for, and how many background upgrades run at once
+app.config['DEFAULT_IMAGE_TIER'] = os.environ.get('DEFAULT_IMAGE_TIER', 'final')
+app.config['DRAFT_IMAGE_TIER'] = os.environ.get('DRAFT_IMAGE_TIER', 'draft')
+app.config['UPGRADE_WORKERS'] = int(os.environ.get('UPGRADE_WORKERS', 2))
+
+# Disk quota: the garbage collector only runs when at least one limit is set (0 = no limit)
+app.config['DISK_GC_INTERVAL'] = int(os.environ.get('DISK_GC_INTERVAL', 600))  # seconds between collections
+app.config['UPLOADS_MAX_MB'] = float(os.environ.get('UPLOADS_MAX_MB', 0))
+app.config['DISHES_MAX_MB'] = float(os.environ.get('DISHES_MAX_MB', 0))
+app.config['UPLOADS_MAX_AGE_DAYS'] = float(os.environ.get('UPLOADS_MAX_AGE_DAYS', 0))
+app.config['DISHES_MAX_AGE_DAYS'] = float(os.environ.get('DISHES_MAX_AGE_DAYS', 0))
+app.config['CACHE_MAX_AGE_DAYS'] = float(os.environ.get('CACHE_MAX_AGE_DAYS', 0))  # thumbnails and composites, rebuilt on demand
+app.config['GC_PROTECT_DAYS'] = float(os.environ.get('GC_PROTECT_DAYS', 30))  # keep images used by uploads this recent
+app.config['CHECKPOINT_MAX_AGE_DAYS'] = float(os.environ.get('CHECKPOINT_MAX_AGE_DAYS', 7))  # forget uploads never resumed
+
+# Admission control: menus processed at once per process, and how many may wait for a slot
+app.config['MAX_CONCURRENT_PIPELINES'] = int(os.environ.get('MAX_CONCURRENT_PIPELINES', 2))
+app.config['MAX_PIPELINE_QUEUE'] = int(os.environ.get('MAX_PIPELINE_QUEUE', 4))
+app.config['PIPELINE_QUEUE_TIMEOUT'] = float(os.environ.get('PIPELINE_QUEUE_TIMEOUT', 60))  # seconds a queued upload waits
+app.config['PIPELINE_RETRY_AFTER'] = int(os.environ.get('PIPELINE_RETRY_AFTER', 30))  # Retry-After sent with 503s
+
+# Negative cache for failed generations: rejected dishes are skipped for FAILURE_TTL_DAYS,
+# transient failures back off exponentially from FAILURE_BACKOFF up to FAILURE_BACKOFF_MAX seconds
+app.config['FAILURE_TTL_DAYS'] = float(os.environ.get('FAILURE_TTL_DAYS', 7))
+app.config['FAILURE_BACKOFF'] = float(os.environ.get('FAILURE_BACKOFF', 60))
+app.config['FAILURE_BACKOFF_MAX'] = float(os.environ.get('FAILURE_BACKOFF_MAX', 3600))
+
+# Batch uploads: menus per request, and how many of them are extracted at once
+app.config['MAX_BATCH_FILES'] = int(os.environ.get('MAX_BATCH_FILES', 30))
+app.config['BATCH_EXTRACTION_WORKERS'] = int(os.environ.get('BATCH_EXTRACTION_WORKERS', 4))
 
 # Ensure directories exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -27,21 +105,92 @@ os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 # Set your OpenAI API key as an environment variable: OPENAI_API_KEY
 API_TOKEN = os.environ.get("OPENAI_API_KEY")
 
-def load_upload_history():
-    """Load upload history from JSON file"""
+_rate_lock = threading.Lock()
+_rate_state = {'tokens': None, 'updated': 0.0}
+
+# Image quality tiers, cheapest first. Costs are approximate USD per image.
+IMAGE_TIERS = {
+    'draft': {'model': 'dall-e-2', 'size': '256x256', 'cost': 0.016},
+    'preview': {'model': 'dall-e-2', 'size': '512x512', 'cost': 0.018},
+    'final': {'model': 'dall-e-3', 'size': '1024x1024', 'cost': 0.04},
+}
+TIER_ORDER = list(IMAGE_TIERS)
+
+PROMPT_STYLES = {
+    'photo': "Professional food photography of {dish}, high quality, appetizing, well-lit, restaurant quality photo",
+    'illustration': "A colorful hand-drawn illustration of {dish} for a restaurant menu, plain light background",
+}
+DEFAULT_PROMPT_STYLE = 'photo'
+
+# Background draft-to-final upgrades, keyed by (canonical dish, tier, style)
+upgrade_executor = ThreadPoolExecutor(max_workers=app.config['UPGRADE_WORKERS'])
+_pending_upgrades = set()
+_upgrades_lock = threading.Lock()
+
+# Last time each served file was requested ("dishes/<name>" or "uploads/<name>"), flushed by the GC
+_access_times = {}
+_access_lock = threading.Lock()
+
+# Guards read-modify-write of the checkpoint and history files between pipeline threads
+_checkpoint_lock = threading.Lock()
+_history_update_lock = threading.Lock()
+
+# Failure classes that will not go away by retrying the same dish; the rest are transient
+PERMANENT_FAILURES = ('policy', 'bad_request')
+# Error codes about the account or request settings rather than the dish, never recorded per dish
+ACCOUNT_ERROR_CODES = (
+    'billing_hard_limit_reached', 'insufficient_quota', 'billing_not_active',
+    'invalid_api_key', 'model_not_found', 'invalid_size', 'invalid_model',
+)
+_failure_lock = threading.Lock()
+
+# Pipelines running and waiting for a slot, guarded by the condition
+_pipeline_slots = threading.Condition()
+_pipeline_state = {'active': 0, 'queued': 0}
+
+# Counters reported by /metrics
+metrics = {
+    'pipelines_admitted': 0,
+    'pipelines_rejected': 0,
+    'pipelines_timed_out': 0,
+    'extraction_hedges_sent': 0,
+    'extraction_hedges_won': 0,
+    'extraction_hedges_skipped_budget': 0,
+}
+_metrics_lock = threading.Lock()
+
+# Recent extraction time-to-first-token samples (seconds), the basis of the hedge delay
+HEDGE_MIN_SAMPLES = 20
+_first_token_latencies = deque(maxlen=200)
+_latency_lock = threading.Lock()
+
+# Thumbnail edge lengths that may be requested, and the illustrated-menu layouts
+THUMBNAIL_SIZES = (128, 256, 512)
+COMPOSITE_LAYOUTS = ('grid', 'list')
+_composite_locks = {}  # composite path -> lock serialising redraws of that file
+_composite_locks_lock = threading.Lock()
+GC_MIN_IDLE_SECONDS = 300  # never evict files touched this recently (uploads still being processed)
+
+def load_upload_history(raise_errors=False):
+    """Load upload history from JSON file.
+
+    With raise_errors set, an unreadable file raises instead of looking like an empty history.
+    """
     try:
         if os.path.exists(app.config['HISTORY_FILE']):
             with open(app.config['HISTORY_FILE'], 'r') as f:
                 return json.load(f)
     except Exception as e:
         logger.error(f"Error loading upload history: {e}")
+        if raise_errors:
+            raise
     return {}
 
 def save_upload_history(history):
     """Save upload history to JSON file"""
     try:
-        with open(app.config['HISTORY_FILE'], 'w') as f:
-            json.dump(history, f, indent=2)
+        # Atomic, so concurrent readers such as the disk GC never see a half-written file
+        write_json_atomically(app.config['HISTORY_FILE'], history, indent=2)
     except Exception as e:
         logger.error(f"Error saving upload history: {e}")
 
@@ -61,86 +210,472 @@ def check_previous_upload(file_hash):
 
 def record_upload(file_hash, filename, dishes, generated_images):
     """Record upload in history"""
-    history = load_upload_history()
-    history[file_hash] = {
-        'filename': filename,
-        'dishes': dishes,
-        'generated_images': generated_images,
-        'timestamp': time.time(),
-        'upload_count': history.get(file_hash, {}).get('upload_count', 0) + 1
-    }
-    save_upload_history(history)
+    # Concurrent pipelines finishing together must not drop each other's entries
+    with _history_update_lock:
+        history = load_upload_history()
+        history[file_hash] = {
+            'filename': filename,
+            'dishes': dishes,
+            'generated_images': generated_images,
+            'timestamp': time.time(),
+            'upload_count': history.get(file_hash, {}).get('upload_count', 0) + 1
+        }
+        save_upload_history(history)
 
-def extract_dishes(image_path):
-    if not API_TOKEN:
-        logger.error("OpenAI API key not set")
-        return {"error": "OpenAI API key not set"}
+EXTRACTION_PROMPT = "You are a menu analysis expert. Look at this menu image and extract all the food items/dishes listed. Return ONLY a JSON array of dish names, nothing else. For example: [\"Beef Taco\", \"Chicken Fajitas\", \"Carne Asada\"]"
+TILE_EXTRACTION_PROMPT = "You are a menu analysis expert. This image is one section of a larger menu. Extract all the food items/dishes listed in this section, skipping any dish name that is cut off at the edge of the image. Return ONLY a JSON array of dish names, nothing else. For example: [\"Beef Taco\", \"Chicken Fajitas\", \"Carne Asada\"]"
+
+def normalize_dish_name(dish_name):
+    """Canonical form of a dish name, used to match the same dish across sources"""
+    return ' '.join(re.sub(r'[^\w\s&]', ' ', dish_name.lower()).split())
+
+def _tile_offsets(length, tile_size, overlap):
+    """Start offsets of overlapping tiles covering one axis of the image"""
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    offsets = list(range(0, length - tile_size, step))
+    offsets.append(length - tile_size)
+    return offsets
+
+def split_menu_into_tiles(image_path):
+    """Split a high-resolution menu into overlapping base64-encoded JPEG tiles.
+
+    Returns None when the image is small enough to be sent whole.
+    """
+    with Image.open(image_path) as img:
+        img = ImageOps.exif_transpose(img)
+        width, height = img.size
+        if max(width, height) < app.config['TILE_MIN_SIDE']:
+            return None
+
+        # Grow the tiles until the grid fits in the tile budget
+        tile_size = app.config['TILE_SIZE']
+        while True:
+            overlap = int(tile_size * app.config['TILE_OVERLAP'])
+            columns = _tile_offsets(width, tile_size, overlap)
+            rows = _tile_offsets(height, tile_size, overlap)
+            if len(columns) * len(rows) <= max(1, app.config['TILE_MAX_TILES']):
+                break
+            tile_size = int(tile_size * 1.25)
+
+        img = img.convert('RGB')
+        tiles = []
+        for top in rows:
+            for left in columns:
+                box = (left, top, min(left + tile_size, width), min(top + tile_size, height))
+                buffer = io.BytesIO()
+                img.crop(box).save(buffer, format='JPEG', quality=90)
+                tiles.append(base64.b64encode(buffer.getvalue()).decode('utf-8'))
+
+    logger.info(f"Split {width}x{height} menu into {len(tiles)} tiles of {tile_size}px")
+    return tiles
+
+class ExtractionError(Exception):
+    """Raised when the vision model cannot produce a dish list for a menu"""
+
+def _stream_completion_text(encoded_image, prompt, model=None):
+    """Stream a vision chat completion for one image, yielding content deltas as they arrive"""
+    headers = {
+        "Authorization": f"Bearer {API_TOKEN}",
+        "Content-Type": "application/json"
+    }
     
-    try:
-        logger.info(f"Starting dish extraction for {image_path}")
-        
-        # Encode the image to base64
-        with open(image_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        logger.info("Image encoded successfully")
-        
-        headers = {
-            "Authorization": f"Bearer {API_TOKEN}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": "gpt-4o",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "You are a menu analysis expert. Look at this menu image and extract all the food items/dishes listed. Return ONLY a JSON array of dish names, nothing else. For example: [\"Beef Taco\", \"Chicken Fajitas\", \"Carne Asada\"]"
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{encoded_image}"
-                            }
+    data = {
+        "model": model or app.config['EXTRACTION_MODEL'],
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{encoded_image}"
                         }
-                    ]
-                }
-            ],
-            "max_tokens": 500
-        }
-        
-        logger.info("Sending request to OpenAI...")
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=data)
+                    }
+                ]
+            }
+        ],
+        "max_tokens": 500,
+        "stream": True
+    }
+    
+    logger.info(f"Sending streaming request to OpenAI ({data['model']})...")
+    try:
+        # The timeout applies to each read, so a stalled stream cannot hang the worker
+        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=data, stream=True, timeout=60)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error in _stream_completion_text: {e}")
+        raise ExtractionError(f"Error extracting dishes: {str(e)}")
+    
+    with response:
+        if response.status_code != 200:
+            logger.error(f"OpenAI API error: {response.status_code} - {response.text}")
+            raise ExtractionError(f"OpenAI API error: {response.status_code}")
         
-        if response.status_code == 200:
-            result = response.json()
-            content = result['choices'][0]['message']['content']
-            logger.info(f"OpenAI response: {content}")
-            
-            # Try to parse JSON response
+        try:
+            # Server-sent events: one "data: {json}" line per chunk, ending with "data: [DONE]"
+            for raw_line in response.iter_lines():
+                line = raw_line.decode('utf-8')
+                if not line.startswith('data: '):
+                    continue
+                payload = line[len('data: '):]
+                if payload == '[DONE]':
+                    break
+                choices = json.loads(payload).get('choices')
+                if choices:
+                    delta = choices[0].get('delta', {}).get('content')
+                    if delta:
+                        yield delta
+        except requests.exceptions.RequestException as e:
+            logger.error(f"OpenAI stream interrupted: {e}")
+            raise ExtractionError(f"Error extracting dishes: {str(e)}")
+
+def record_first_token_latency(seconds):
+    with _latency_lock:
+        _first_token_latencies.append(seconds)
+
+def extraction_hedge_delay():
+    """Seconds to wait for a first token before hedging: the configured percentile of recent samples"""
+    with _latency_lock:
+        samples = sorted(_first_token_latencies)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return app.config['EXTRACTION_HEDGE_DELAY']
+    index = min(len(samples) - 1, int(len(samples) * app.config['EXTRACTION_HEDGE_PERCENTILE'] / 100))
+    return samples[index]
+
+def _hedged_completion_text(encoded_image, prompt):
+    """Stream a completion, racing a hedge request against a primary that is slow to start.
+
+    If the primary has not produced its first token after extraction_hedge_delay(),
+    a second request is sent (when the rate budget allows) and whichever attempt
+    starts streaming first is used. The other is abandoned: it closes its
+    connection at its next chunk and its output is ignored.
+    """
+    if not app.config['EXTRACTION_HEDGE']:
+        started = time.monotonic()
+        first = True
+        for delta in _stream_completion_text(encoded_image, prompt):
+            if first:
+                record_first_token_latency(time.monotonic() - started)
+                first = False
+            yield delta
+        return
+    
+    events = queue.Queue()
+    abandoned = set()
+    
+    def run_attempt(attempt, model):
+        started = time.monotonic()
+        first = True
+        stream = _stream_completion_text(encoded_image, prompt, model)
+        try:
+            for delta in stream:
+                if first and attempt == 'primary':
+                    # Sample the primary even when the hedge won, or the tail the
+                    # percentile estimates would be censored and the delay would creep down
+                    record_first_token_latency(time.monotonic() - started)
+                first = False
+                if attempt in abandoned:
+                    return
+                events.put((attempt, 'delta', delta))
+            events.put((attempt, 'done', None))
+        except Exception as e:
+            events.put((attempt, 'error', e if isinstance(e, ExtractionError) else ExtractionError(f"Error extracting dishes: {e}")))
+        finally:
+            stream.close()
+    
+    def start_attempt(attempt, model=None):
+        threading.Thread(target=run_attempt, args=(attempt, model), daemon=True).start()
+    
+    start_attempt('primary')
+    deadline = time.monotonic() + extraction_hedge_delay()
+    running = {'primary'}
+    hedged = False
+    winner = None
+    try:
+        while True:
+            timeout = None if winner or hedged else max(0, deadline - time.monotonic())
             try:
-                dishes = json.loads(content)
-                if isinstance(dishes, list):
-                    logger.info(f"Successfully extracted {len(dishes)} dishes")
-                    return {"dishes": dishes}
+                attempt, kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                hedged = True
+                if acquire_api_token(blocking=False):
+                    logger.info("Extraction slow to start, sending a hedge request")
+                    increment_metric('extraction_hedges_sent')
+                    start_attempt('hedge', app.config['EXTRACTION_HEDGE_MODEL'] or None)
+                    running.add('hedge')
                 else:
-                    logger.error("Response is not a list")
-                    return {"error": "Invalid response format"}
-            except json.JSONDecodeError:
-                logger.error(f"Failed to parse JSON: {content}")
-                return {"error": "Failed to parse response"}
-        else:
-            logger.error(f"OpenAI API error: {response.status_code} - {response.text}")
-            return {"error": f"OpenAI API error: {response.status_code}"}
+                    increment_metric('extraction_hedges_skipped_budget')
+                continue
+            
+            if winner is None:
+                if kind == 'error' and running - {attempt}:
+                    # The other attempt may still succeed
+                    logger.warning(f"Extraction {attempt} request failed, waiting for the other: {value}")
+                    running.discard(attempt)
+                    continue
+                winner = attempt
+                abandoned.update(running - {winner})
+                if winner == 'hedge':
+                    increment_metric('extraction_hedges_won')
+            elif attempt != winner:
+                continue
+            
+            if kind == 'delta':
+                yield value
+            elif kind == 'done':
+                return
+            else:
+                raise value
+    finally:
+        abandoned.update(running)
+
+def stream_dish_names(encoded_image, prompt):
+    """Yield dish names from a streamed JSON array as soon as each string literal closes.
+
+    Only the string literals directly inside the first top-level array are
+    dishes, so code fences, keys or stray text around it are ignored, and the
+    stream is dropped as soon as the array closes.
+    """
+    literal = None  # characters of the string literal being read, None between strings
+    escaped = False
+    depth = 0  # bracket depth; the dish array is depth 1
+    found_any = False
+    for delta in _hedged_completion_text(encoded_image, prompt):
+        for char in delta:
+            if literal is None:
+                if char == '"':
+                    literal = [char]
+                elif char == '[':
+                    depth += 1
+                elif char == ']' and depth:
+                    depth -= 1
+                    if not depth:
+                        if not found_any:
+                            logger.error("Response contained an empty array of dish names")
+                        return
+                continue
             
+            literal.append(char)
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                text = ''.join(literal)
+                literal = None
+                if depth != 1:
+                    continue
+                try:
+                    dish = json.loads(text).strip()
+                except json.JSONDecodeError:
+                    logger.error(f"Failed to parse JSON string: {text}")
+                    dish = ''
+                if dish:
+                    found_any = True
+                    yield dish
+    
+    if not found_any:
+        logger.error("Response did not contain a JSON array of dish names")
+
+def _merge_tile_streams(sources, status):
+    """Stream every tile concurrently, yielding dish names from whichever tile produces them first.
+
+    If only some tiles fail, the dishes from the rest are still yielded and
+    status['incomplete'] is set so the partial menu is not kept for good.
+    """
+    events = queue.Queue()
+    
+    def stream_tile(encoded_image, prompt):
+        try:
+            for dish in stream_dish_names(encoded_image, prompt):
+                events.put(('dish', dish))
+            events.put(('done', None))
+        except ExtractionError as e:
+            events.put(('error', e))
+        except Exception as e:
+            events.put(('error', ExtractionError(f"Error extracting dishes: {str(e)}")))
+    
+    executor = ThreadPoolExecutor(max_workers=app.config['TILE_WORKERS'])
+    for encoded_image, prompt in sources:
+        executor.submit(stream_tile, encoded_image, prompt)
+    executor.shutdown(wait=False)
+    
+    errors = []
+    finished = 0
+    while finished < len(sources):
+        kind, value = events.get()
+        if kind == 'dish':
+            yield value
+            continue
+        finished += 1
+        if kind == 'error':
+            errors.append(value)
+    
+    if len(errors) == len(sources):
+        raise errors[0]
+    if errors:
+        logger.warning(f"{len(errors)} of {len(sources)} tiles failed, returning partial menu")
+        status['incomplete'] = True
+
+def iter_menu_dishes(image_path, status=None):
+    """Yield each unique dish name on a menu the moment it appears in the model's reply.
+
+    Raises ExtractionError if the menu could not be read at all. If only part
+    of it could be read, status['incomplete'] is set once the stream ends.
+    """
+    if status is None:
+        status = {}
+    if not API_TOKEN:
+        logger.error("OpenAI API key not set")
+        raise ExtractionError("OpenAI API key not set")
+    
+    logger.info(f"Starting dish extraction for {image_path}")
+    
+    tiles = None
+    if app.config['TILED_EXTRACTION']:
+        try:
+            tiles = split_menu_into_tiles(image_path)
+        except Exception as e:
+            logger.warning(f"Could not tile menu image, sending it whole: {e}")
+    
+    if tiles:
+        dish_stream = _merge_tile_streams([(tile, TILE_EXTRACTION_PROMPT) for tile in tiles], status)
+    else:
+        try:
+            # Encode the image to base64
+            with open(image_path, "rb") as image_file:
+                encoded_image = base64.b64encode(image_file.read()).decode('utf-8')
+        except Exception as e:
+            logger.error(f"Error in iter_menu_dishes: {e}")
+            raise ExtractionError(f"Error extracting dishes: {str(e)}")
+        
+        dish_stream = stream_dish_names(encoded_image, EXTRACTION_PROMPT)
+    
+    # Overlapping tiles (and chatty replies) can repeat a dish
+    seen = set()
+    for dish in dish_stream:
+        key = normalize_dish_name(dish)
+        if key and key not in seen:
+            seen.add(key)
+            yield dish
+
+def acquire_api_token(blocking=True):
+    """Take one OpenAI call from the shared token-bucket rate budget.
+
+    With blocking=False, returns False instead of waiting when the budget is spent.
+    """
+    rate = app.config['API_RATE_PER_MINUTE'] / 60.0
+    if rate <= 0:
+        return True
+    burst = app.config['API_RATE_BURST']
+    
+    while True:
+        with _rate_lock:
+            now = time.monotonic()
+            if _rate_state['tokens'] is None:
+                tokens = burst
+            else:
+                tokens = min(burst, _rate_state['tokens'] + (now - _rate_state['updated']) * rate)
+            _rate_state['updated'] = now
+            if tokens >= 1:
+                _rate_state['tokens'] = tokens - 1
+                return True
+            _rate_state['tokens'] = tokens
+            wait = (1 - tokens) / rate
+        
+        if not blocking:
+            return False
+        time.sleep(wait)
+
+def load_generation_failures():
+    """Load recorded image generation failures, keyed by canonical dish name"""
+    try:
+        if os.path.exists(app.config['FAILURE_CACHE_FILE']):
+            with open(app.config['FAILURE_CACHE_FILE'], 'r') as f:
+                return json.load(f)
     except Exception as e:
-        logger.error(f"Error in extract_dishes: {e}")
-        return {"error": f"Error extracting dishes: {str(e)}"}
+        logger.error(f"Error loading generation failures: {e}")
+    return {}
+
+def _update_generation_failures(update):
+    with _failure_lock:
+        failures = load_generation_failures()
+        if update(failures) is False:
+            return
+        try:
+            write_json_atomically(app.config['FAILURE_CACHE_FILE'], failures)
+        except Exception as e:
+            logger.error(f"Error saving generation failures: {e}")
+
+def record_generation_failure(dish, error_class, detail=''):
+    """Remember that generating this dish failed, and until when it should not be retried"""
+    def update(failures):
+        now = time.time()
+        previous = failures.get(normalize_dish_name(dish), {})
+        attempts = previous.get('attempts', 0) + 1
+        if error_class in PERMANENT_FAILURES:
+            retry_at = now + app.config['FAILURE_TTL_DAYS'] * 86400
+        else:
+            retry_at = now + min(app.config['FAILURE_BACKOFF_MAX'], app.config['FAILURE_BACKOFF'] * 2 ** (attempts - 1))
+        failures[normalize_dish_name(dish)] = {
+            'dish': dish,
+            'error_class': error_class,
+            'permanent': error_class in PERMANENT_FAILURES,
+            'detail': detail[:200],
+            'attempts': attempts,
+            'failed_at': now,
+            'retry_at': retry_at
+        }
+    logger.warning(f"Recording {error_class} generation failure for: {dish}")
+    _update_generation_failures(update)
+
+def clear_generation_failure(dish):
+    """Forget earlier failures of a dish once it has generated successfully"""
+    def update(failures):
+        if failures.pop(normalize_dish_name(dish), None) is None:
+            return False
+    _update_generation_failures(update)
+
+def active_generation_failure(dish):
+    """The recorded failure of a dish if it should not be retried yet, else None"""
+    failure = load_generation_failures().get(normalize_dish_name(dish))
+    if failure and failure['retry_at'] > time.time():
+        return failure
+    return None
+
+def classify_generation_failure(response):
+    """Failure class of a non-200 image generation response, None when the dish is not to blame.
 
-def generate_image_with_openai(prompt, output_path):
+    A 400 is only held against the dish when the error points at the prompt;
+    billing, quota, model and size errors would otherwise blacklist every dish
+    seen during an account or configuration outage.
+    """
+    try:
+        error = response.json().get('error') or {}
+    except Exception:
+        error = {}
+    code = error.get('code') or ''
+    message = (error.get('message') or '').lower()
+    
+    if code in ACCOUNT_ERROR_CODES:
+        return None
+    if response.status_code == 429:
+        return 'rate_limit'
+    if response.status_code >= 500:
+        return 'server'
+    if code == 'content_policy_violation' or 'safety system' in message:
+        return 'policy'
+    if response.status_code in (400, 422) and (error.get('param') == 'prompt' or 'prompt' in message):
+        return 'bad_request'
+    return None  # authentication, account and configuration errors affect every dish alike
+
+def generate_image_with_openai(prompt, output_path, tier='final', style=DEFAULT_PROMPT_STYLE):
     if not API_TOKEN:
         logger.error("OpenAI API key not set")
         return False
@@ -154,34 +689,46 @@ def generate_image_with_openai(prompt, output_path):
         }
         
         data = {
-            "model": "dall-e-3",
-            "prompt": f"Professional food photography of {prompt}, high quality, appetizing, well-lit, restaurant quality photo",
+            "model": IMAGE_TIERS[tier]['model'],
+            "prompt": PROMPT_STYLES[style].format(dish=prompt),
             "n": 1,
-            "size": "1024x1024"
+            "size": IMAGE_TIERS[tier]['size']
         }
         
-        logger.info("Sending image generation request to OpenAI...")
-        response = requests.post("https://api.openai.com/v1/images/generations", headers=headers, json=data)
+        logger.info(f"Sending {tier} image generation request to OpenAI...")
+        response = requests.post("https://api.openai.com/v1/images/generations", headers=headers, json=data, timeout=60)
         
         if response.status_code == 200:
             result = response.json()
             image_url = result['data'][0]['url']
             
             logger.info("Downloading generated image...")
-            img_response = requests.get(image_url)
+            img_response = requests.get(image_url, timeout=30)
             
             if img_response.status_code == 200:
-                with open(output_path, 'wb') as f:
+                # Write through a hidden temporary file so a killed worker never leaves a truncated image
+                tmp_path = os.path.join(os.path.dirname(output_path), f".{os.path.basename(output_path)}.{os.getpid()}.tmp")
+                with open(tmp_path, 'wb') as f:
                     f.write(img_response.content)
+                os.replace(tmp_path, output_path)
                 logger.info(f"Image saved to: {output_path}")
+                clear_generation_failure(prompt)
                 return True
             else:
                 logger.error(f"Failed to download image: {img_response.status_code}")
+                record_generation_failure(prompt, 'server', f"download {img_response.status_code}")
                 return False
         else:
             logger.error(f"OpenAI image generation error: {response.status_code} - {response.text}")
+            error_class = classify_generation_failure(response)
+            if error_class:
+                record_generation_failure(prompt, error_class, response.text)
             return False
             
+    except requests.exceptions.Timeout:
+        logger.error(f"Timeout generating image for: {prompt}")
+        record_generation_failure(prompt, 'timeout')
+        return False
     except Exception as e:
         logger.error(f"Error in generate_image_with_openai: {e}")
         return False
@@ -222,7 +769,8 @@ def find_existing_image(dish_name, output_folder):
         # Check for partial matches
         dish_words = dish_name.lower().split()
         for filename in files:
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+            # Tier/style variants ("<dish>__<tier>__<style>.png") are looked up separately
+            if filename.lower().endswith(('.png', '.jpg', '.jpeg')) and '__' not in filename:
                 filename_lower = filename.lower()
                 # Check if all words in dish name appear in filename
                 if all(word in filename_lower for word in dish_words):
@@ -234,6 +782,830 @@ def find_existing_image(dish_name, output_folder):
         logger.error(f"Error finding existing image: {e}")
         return None, None
 
+def load_checkpoints():
+    """Load in-progress upload checkpoints from JSON file, leaving out expired ones"""
+    try:
+        if os.path.exists(app.config['CHECKPOINT_FILE']):
+            with open(app.config['CHECKPOINT_FILE'], 'r') as f:
+                checkpoints = json.load(f)
+            cutoff = time.time() - app.config['CHECKPOINT_MAX_AGE_DAYS'] * 86400
+            return {file_hash: checkpoint for file_hash, checkpoint in checkpoints.items()
+                    if checkpoint.get('timestamp', 0) >= cutoff}
+    except Exception as e:
+        logger.error(f"Error loading upload checkpoints: {e}")
+    return {}
+
+def load_checkpoint(file_hash):
+    """Checkpoint of an unfinished upload of this file, if any"""
+    if not file_hash:
+        return None
+    return load_checkpoints().get(file_hash)
+
+def _update_checkpoints(update):
+    with _checkpoint_lock:
+        checkpoints = load_checkpoints()
+        update(checkpoints)
+        try:
+            write_json_atomically(app.config['CHECKPOINT_FILE'], checkpoints)
+        except Exception as e:
+            logger.error(f"Error saving upload checkpoints: {e}")
+
+def save_checkpoint_dishes(file_hash, filename, dishes):
+    """Record the finished extraction stage of an upload"""
+    def update(checkpoints):
+        checkpoint = checkpoints.setdefault(file_hash, {'images': {}})
+        checkpoint.update({'filename': filename, 'dishes': dishes, 'timestamp': time.time()})
+    _update_checkpoints(update)
+
+def save_checkpoint_image(file_hash, image):
+    """Record one finished dish image of an upload"""
+    def update(checkpoints):
+        checkpoint = checkpoints.setdefault(file_hash, {'images': {}})
+        checkpoint['images'][normalize_dish_name(image['dish'])] = image
+        checkpoint['timestamp'] = time.time()
+    _update_checkpoints(update)
+
+def clear_checkpoint(file_hash):
+    """Forget the checkpoint once the upload is recorded in history or has failed for good"""
+    _update_checkpoints(lambda checkpoints: checkpoints.pop(file_hash, None))
+
+def expire_checkpoints():
+    """Rewrite the checkpoint file without checkpoints older than CHECKPOINT_MAX_AGE_DAYS"""
+    _update_checkpoints(lambda checkpoints: None)  # load_checkpoints already left them out
+
+def checkpointed_dishes(file_hash, filename, image_path, status=None):
+    """Yield a menu's dishes, replaying the checkpoint when an earlier attempt finished extraction.
+
+    A fresh extraction is checkpointed as soon as the stream is exhausted,
+    unless status['incomplete'] says part of the menu could not be read.
+    """
+    if status is None:
+        status = {}
+    checkpoint = load_checkpoint(file_hash)
+    if checkpoint and 'dishes' in checkpoint:
+        logger.info(f"Resuming upload from checkpoint: {len(checkpoint['dishes'])} dishes, {len(checkpoint['images'])} images already done")
+        yield from checkpoint['dishes']
+        return
+    
+    dishes = []
+    for dish in iter_menu_dishes(image_path, status):
+        dishes.append(dish)
+        yield dish
+    
+    if file_hash and dishes and not status.get('incomplete'):
+        save_checkpoint_dishes(file_hash, filename, dishes)
+
+def tier_image_filename(dish_name, tier, style=DEFAULT_PROMPT_STYLE):
+    """Cache filename for a (dish, tier, prompt style) combination.
+
+    The final tier in the default style keeps the plain "<dish>.png" name so
+    images generated before tiers existed are still found.
+    """
+    sanitized_dish = sanitize_filename(dish_name)
+    if tier == 'final' and style == DEFAULT_PROMPT_STYLE:
+        return f"{sanitized_dish}.png"
+    return f"{sanitized_dish}__{tier}__{style}.png"
+
+def find_cached_image(dish_name, tier, style=DEFAULT_PROMPT_STYLE):
+    """Find the cached image for exactly this dish, tier and style"""
+    if tier == 'final' and style == DEFAULT_PROMPT_STYLE:
+        return find_existing_image(dish_name, app.config['OUTPUT_FOLDER'])
+    
+    filename = tier_image_filename(dish_name, tier, style)
+    path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
+    if os.path.exists(path):
+        return filename, path
+    return None, None
+
+def find_best_cached_image(dish_name, style=DEFAULT_PROMPT_STYLE):
+    """Find the highest-quality cached tier for a dish; returns (filename, path, tier)"""
+    for tier in reversed(TIER_ORDER):
+        filename, path = find_cached_image(dish_name, tier, style)
+        if filename:
+            return filename, path, tier
+    return None, None, None
+
+def image_entry(dish, filename, tier, style=DEFAULT_PROMPT_STYLE):
+    """Image entry as returned to the UI and stored in upload history"""
+    return {
+        'dish': dish,
+        'filename': filename,
+        'path': f'/image/{filename}',
+        'tier': tier,
+        'style': style
+    }
+
+def generate_dish_image(dish, tier='final', style=DEFAULT_PROMPT_STYLE):
+    """Generate a new image for a dish, returning its image entry or None on failure"""
+    logger.info(f"Generating new {tier} image for: {dish}")
+    # Create consistent filename for new images
+    image_filename = tier_image_filename(dish, tier, style)
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], image_filename)
+    
+    if active_generation_failure(dish):
+        logger.info(f"Skipping {dish}: generation failed recently")
+        return None
+    
+    acquire_api_token()  # Rate limiting
+    if generate_image_with_openai(dish, output_path, tier, style):
+        logger.info(f"Successfully generated {tier} image for: {dish}")
+        return image_entry(dish, image_filename, tier, style)
+    
+    logger.error(f"Failed to generate {tier} image for: {dish}")
+    return None
+
+def _upgrade_key(dish, tier, style):
+    return (normalize_dish_name(dish), tier, style)
+
+def is_upgrade_pending(dish, tier, style=DEFAULT_PROMPT_STYLE):
+    """Whether a background upgrade of this dish to this tier is queued or running"""
+    with _upgrades_lock:
+        return _upgrade_key(dish, tier, style) in _pending_upgrades
+
+def schedule_tier_upgrade(dish, tier, style=DEFAULT_PROMPT_STYLE):
+    """Generate a higher tier of a dish image in the background, at most once at a time"""
+    key = _upgrade_key(dish, tier, style)
+    with _upgrades_lock:
+        if key in _pending_upgrades:
+            return
+        _pending_upgrades.add(key)
+    
+    def upgrade():
+        try:
+            if not find_cached_image(dish, tier, style)[0]:
+                generate_dish_image(dish, tier, style)
+        except Exception as e:
+            logger.error(f"Error upgrading '{dish}' to {tier}: {e}")
+        finally:
+            with _upgrades_lock:
+                _pending_upgrades.discard(key)
+    
+    upgrade_executor.submit(upgrade)
+
+def _generate_draft_then_upgrade(dish, tier, style):
+    image = generate_dish_image(dish, app.config['DRAFT_IMAGE_TIER'], style)
+    schedule_tier_upgrade(dish, tier, style)
+    if image:
+        image['upgrading'] = True
+    return image
+
+def refresh_image_tiers(images):
+    """Point stored image entries at the best tier now cached for each dish"""
+    refreshed = []
+    for image in images:
+        style = image.get('style', DEFAULT_PROMPT_STYLE)
+        filename, _, tier = find_best_cached_image(image['dish'], style)
+        if filename and TIER_ORDER.index(tier) > TIER_ORDER.index(image.get('tier', 'final')):
+            image = image_entry(image['dish'], filename, tier, style)
+        refreshed.append(image)
+    return refreshed
+
+def process_menu_dishes(dish_stream, tier='final', style=DEFAULT_PROMPT_STYLE, progressive=False, checkpoint_hash=None):
+    """Resolve an image for every dish as it arrives from the extraction stream.
+
+    Cached images are looked up immediately and missing ones are handed to the
+    generation pool, so image generation overlaps with extraction. With
+    progressive set, dishes without a cached image of the requested tier get a
+    fast draft (or the best lower tier already cached) now and are upgraded in
+    the background. With checkpoint_hash set, dish images finished by an
+    earlier attempt are reused and each new image is checkpointed as soon as
+    it is saved. Dishes whose generation failed recently are not retried.
+    Returns (dishes, generated_images, skipped_images, failed_images) in menu order.
+    """
+    dishes = []
+    skipped_images = []
+    failed_images = []
+    pending = []  # (dish, image entry or Future), in menu order
+    
+    checkpoint_images = (load_checkpoint(checkpoint_hash) or {}).get('images', {})
+    
+    def checkpoint_generated(future):
+        image = future.result()
+        if image and checkpoint_hash:
+            save_checkpoint_image(checkpoint_hash, image)
+    
+    with ThreadPoolExecutor(max_workers=app.config['GENERATION_WORKERS']) as generation_pool:
+        for dish in dish_stream:
+            dishes.append(dish)
+            logger.info(f"Processing dish {len(dishes)}: {dish}")
+            
+            # Resume dishes already finished by an interrupted attempt
+            finished = checkpoint_images.get(normalize_dish_name(dish))
+            if finished and os.path.exists(os.path.join(app.config['OUTPUT_FOLDER'], finished['filename'])):
+                logger.info(f"Image for {dish} restored from checkpoint: {finished['filename']}")
+                pending.append((dish, finished))
+                continue
+            
+            # Try to find the best cached tier, including old naming patterns
+            existing_filename, existing_path, existing_tier = find_best_cached_image(dish, style)
+            upgrade_needed = existing_filename is not None and TIER_ORDER.index(existing_tier) < TIER_ORDER.index(tier)
+            
+            if existing_filename and (not upgrade_needed or progressive):
+                logger.info(f"Image already exists for: {dish} at {existing_path} ({existing_tier})")
+                image = image_entry(dish, existing_filename, existing_tier, style)
+                if upgrade_needed:
+                    schedule_tier_upgrade(dish, tier, style)
+                    image['upgrading'] = True
+                skipped_images.append(dict(image, status='existing'))
+                pending.append((dish, image))
+            elif active_generation_failure(dish):
+                logger.info(f"Skipping {dish}: generation failed recently")
+                pending.append((dish, None))
+            else:
+                if progressive and TIER_ORDER.index(app.config['DRAFT_IMAGE_TIER']) < TIER_ORDER.index(tier):
+                    future = generation_pool.submit(_generate_draft_then_upgrade, dish, tier, style)
+                else:
+                    future = generation_pool.submit(generate_dish_image, dish, tier, style)
+                future.add_done_callback(checkpoint_generated)
+                pending.append((dish, future))
+    
+    generated_images = []
+    for dish, item in pending:
+        image = item.result() if isinstance(item, Future) else item
+        if image:
+            generated_images.append(image)
+            continue
+        failure = active_generation_failure(dish) or {}
+        failed_images.append({
+            'dish': dish,
+            'error_class': failure.get('error_class', 'unknown'),
+            'permanent': failure.get('permanent', False),
+            'retry_at': failure.get('retry_at')
+        })
+    
+    return dishes, generated_images, skipped_images, failed_images
+
+def process_menu_batch(menus, tier='final', style=DEFAULT_PROMPT_STYLE, progressive=False, workers=None):
+    """Extract several menus in parallel, then resolve each dish shared between them only once.
+
+    menus is a list of (file_hash, filename, filepath). All dish sets are merged
+    by canonical name before any image lookup or generation. Returns a dict
+    mapping each file_hash to its dishes, generated_images, skipped_images,
+    failed_images and incomplete flag (or to an error), plus the number of
+    unique dishes resolved.
+    At most workers menus (default BATCH_EXTRACTION_WORKERS) are extracted at once.
+    """
+    results = {}
+    statuses = {file_hash: {} for file_hash, _, _ in menus}
+    with ThreadPoolExecutor(max_workers=workers or app.config['BATCH_EXTRACTION_WORKERS']) as extraction_pool:
+        futures = {
+            file_hash: extraction_pool.submit(lambda menu: list(checkpointed_dishes(*menu)), (file_hash, filename, filepath, statuses[file_hash]))
+            for file_hash, filename, filepath in menus
+        }
+    
+    extracted = {}
+    for file_hash, future in futures.items():
+        try:
+            extracted[file_hash] = future.result()
+        except Exception as e:
+            logger.error(f"Dish extraction failed for batch menu {file_hash[:12]}: {e}")
+            results[file_hash] = {'error': str(e)}
+    
+    # Merge the dish sets, keeping the first spelling seen of each dish
+    unique_dishes = {}
+    for dishes in extracted.values():
+        for dish in dishes:
+            unique_dishes.setdefault(normalize_dish_name(dish), dish)
+    logger.info(f"Batch of {len(menus)} menus: {sum(len(dishes) for dishes in extracted.values())} dishes, {len(unique_dishes)} unique")
+    
+    _, generated_images, skipped_images, failed_images = process_menu_dishes(list(unique_dishes.values()), tier, style, progressive)
+    resolved = {normalize_dish_name(image['dish']): image for image in generated_images}
+    existing = {normalize_dish_name(image['dish']): image for image in skipped_images}
+    failed = {normalize_dish_name(image['dish']): image for image in failed_images}
+    
+    for file_hash, dishes in extracted.items():
+        if not dishes:
+            results[file_hash] = {'error': 'No dishes found in the menu image'}
+            continue
+        keys = [normalize_dish_name(dish) for dish in dishes]
+        results[file_hash] = {
+            'dishes': dishes,
+            'generated_images': [dict(resolved[key], dish=dish) for key, dish in zip(keys, dishes) if key in resolved],
+            'skipped_images': [dict(existing[key], dish=dish) for key, dish in zip(keys, dishes) if key in existing],
+            'failed_images': [dict(failed[key], dish=dish) for key, dish in zip(keys, dishes) if key in failed],
+            'incomplete': statuses[file_hash].get('incomplete', False),
+        }
+    return results, len(unique_dishes)
+
+def write_json_atomically(path, data, indent=None):
+    """Write JSON through a temporary file so readers never see a half-written file"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=indent)
+    os.replace(tmp_path, path)
+
+def record_access(kind, filename):
+    """Note that a file in dishes/ or uploads/ was just served"""
+    with _access_lock:
+        _access_times[f"{kind}/{filename}"] = time.time()
+
+def flush_access_log():
+    """Merge in-memory access times into the access log file and return the merged log"""
+    with _access_lock:
+        recent = dict(_access_times)
+        _access_times.clear()
+    
+    access_log = {}
+    try:
+        if os.path.exists(app.config['ACCESS_LOG_FILE']):
+            with open(app.config['ACCESS_LOG_FILE'], 'r') as f:
+                access_log = json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading access log: {e}")
+    
+    for key, accessed in recent.items():
+        access_log[key] = max(accessed, access_log.get(key, 0))
+    
+    try:
+        write_json_atomically(app.config['ACCESS_LOG_FILE'], access_log)
+    except Exception as e:
+        logger.error(f"Error saving access log: {e}")
+    return access_log
+
+def referenced_images(history):
+    """Filenames of every tier of the dish images used by recent or unfinished uploads"""
+    cutoff = time.time() - app.config['GC_PROTECT_DAYS'] * 86400
+    protected = set()
+    for entry in history.values():
+        if entry.get('timestamp', 0) < cutoff:
+            continue
+        for image in entry.get('generated_images', []):
+            protected.add(image['filename'])
+            style = image.get('style', DEFAULT_PROMPT_STYLE)
+            for tier in TIER_ORDER:
+                protected.add(tier_image_filename(image['dish'], tier, style))
+    
+    # Images already paid for by unfinished uploads are needed when they resume
+    for checkpoint in load_checkpoints().values():
+        for image in checkpoint.get('images', {}).values():
+            protected.add(image['filename'])
+    return protected
+
+def _evict_folder(kind, folder, max_bytes, max_age, access_log, protected):
+    """Delete least recently used files until the folder is within its age and size limits"""
+    now = time.time()
+    files = []
+    for entry in os.scandir(folder):
+        # Skip subfolders, .gitkeep and in-progress temporary files
+        if not entry.is_file() or entry.name.startswith('.') or entry.name.endswith('.tmp'):
+            continue
+        stat = entry.stat()
+        last_used = max(stat.st_mtime, access_log.get(f"{kind}/{entry.name}", 0))
+        files.append((last_used, entry.name, stat.st_size))
+    
+    files.sort()  # least recently used first
+    total_bytes = sum(size for _, _, size in files)
+    evicted = []
+    for last_used, name, size in files:
+        too_old = max_age > 0 and now - last_used > max_age
+        too_big = max_bytes > 0 and total_bytes > max_bytes
+        if not too_old and not too_big:
+            break
+        if name in protected or now - last_used < GC_MIN_IDLE_SECONDS:
+            continue
+        try:
+            os.remove(os.path.join(folder, name))
+        except OSError as e:
+            logger.error(f"Error evicting {kind}/{name}: {e}")
+            continue
+        total_bytes -= size
+        evicted.append(name)
+        access_log.pop(f"{kind}/{name}", None)
+    
+    if evicted:
+        logger.info(f"Evicted {len(evicted)} files from {kind}/, {total_bytes / 1024 / 1024:.1f} MB left")
+    return evicted
+
+def evict_derived_cache(history):
+    """Delete thumbnails and composites that are orphaned or older than CACHE_MAX_AGE_DAYS.
+
+    Thumbnails are orphaned once their dish image is gone, composites once their
+    menu has left the upload history. Both are rebuilt on the next request.
+    """
+    now = time.time()
+    max_age = app.config['CACHE_MAX_AGE_DAYS'] * 86400
+    
+    def expired(entry):
+        age = now - entry.stat().st_mtime
+        return age >= GC_MIN_IDLE_SECONDS and max_age > 0 and age > max_age
+    
+    stale_thumbs, stale_composites = [], []
+    thumb_folder = os.path.join(app.config['CACHE_FOLDER'], 'thumbs')
+    if os.path.isdir(thumb_folder):
+        dish_stems = {os.path.splitext(name)[0] for name in os.listdir(app.config['OUTPUT_FOLDER'])}
+        for entry in os.scandir(thumb_folder):
+            if not entry.is_file() or entry.name.endswith('.tmp'):
+                continue
+            stem = os.path.splitext(entry.name)[0].rpartition('_')[0]
+            if stem not in dish_stems or expired(entry):
+                stale_thumbs.append(entry.path)
+    
+    composite_folder = os.path.join(app.config['CACHE_FOLDER'], 'composites')
+    if os.path.isdir(composite_folder):
+        for entry in os.scandir(composite_folder):
+            if not entry.is_file() or not entry.name.endswith('.png'):
+                continue
+            file_hash = entry.name.split('_', 1)[0]
+            if file_hash not in history or expired(entry):
+                stale_composites.append(entry.path)
+    
+    removed = []
+    def remove(path):
+        try:
+            os.remove(path)
+            removed.append(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Error evicting {path}: {e}")
+    
+    for path in stale_thumbs:
+        remove(path)
+    for path in stale_composites:
+        # Never delete a composite or its manifest halfway through a redraw
+        with _composite_path_lock(path):
+            remove(path)
+            remove(f"{os.path.splitext(path)[0]}.json")
+    if removed:
+        logger.info(f"Evicted {len(removed)} derived files from {app.config['CACHE_FOLDER']}")
+    return removed
+
+def collect_garbage():
+    """Evict cold uploads and dish images beyond the configured size and age limits.
+
+    Dish images referenced by recent upload-history entries are never evicted.
+    Thumbnails and composites derived from files that are gone are removed too.
+    The pass is skipped when the upload history cannot be read, since nothing
+    would be protected.
+    """
+    try:
+        history = load_upload_history(raise_errors=True)
+    except Exception as e:
+        logger.error(f"Skipping garbage collection, upload history is unreadable: {e}")
+        return {'uploads': [], 'dishes': [], 'cache': []}
+    
+    expire_checkpoints()
+    access_log = flush_access_log()
+    evicted = {
+        'uploads': _evict_folder(
+            'uploads', app.config['UPLOAD_FOLDER'],
+            app.config['UPLOADS_MAX_MB'] * 1024 * 1024,
+            app.config['UPLOADS_MAX_AGE_DAYS'] * 86400,
+            access_log, set()
+        ),
+        'dishes': _evict_folder(
+            'dishes', app.config['OUTPUT_FOLDER'],
+            app.config['DISHES_MAX_MB'] * 1024 * 1024,
+            app.config['DISHES_MAX_AGE_DAYS'] * 86400,
+            access_log, referenced_images(history)
+        ),
+    }
+    evicted['cache'] = evict_derived_cache(history)
+    
+    # Forget access times of files that are gone, whether evicted now or deleted by hand
+    folders = {'uploads': app.config['UPLOAD_FOLDER'], 'dishes': app.config['OUTPUT_FOLDER']}
+    stale = []
+    for key in access_log:
+        kind, _, name = key.partition('/')
+        if kind not in folders or not name or not os.path.isfile(os.path.join(folders[kind], name)):
+            stale.append(key)
+    for key in stale:
+        del access_log[key]
+    
+    if evicted['uploads'] or evicted['dishes'] or stale:
+        # Drop access times of evicted files (flushing again keeps newer accesses)
+        try:
+            write_json_atomically(app.config['ACCESS_LOG_FILE'], access_log)
+        except Exception as e:
+            logger.error(f"Error saving access log: {e}")
+    return evicted
+
+def start_disk_gc():
+    """Start the background garbage collector when a disk limit is configured"""
+    limits = [
+        app.config['UPLOADS_MAX_MB'], app.config['DISHES_MAX_MB'],
+        app.config['UPLOADS_MAX_AGE_DAYS'], app.config['DISHES_MAX_AGE_DAYS'],
+        app.config['CACHE_MAX_AGE_DAYS'],
+    ]
+    if app.config['DISK_GC_INTERVAL'] <= 0 or not any(limits):
+        return None
+    
+    def run():
+        while True:
+            time.sleep(app.config['DISK_GC_INTERVAL'])
+            try:
+                collect_garbage()
+            except Exception as e:
+                logger.error(f"Error collecting garbage: {e}")
+    
+    thread = threading.Thread(target=run, name='disk-gc', daemon=True)
+    thread.start()
+    logger.info(f"Disk garbage collector running every {app.config['DISK_GC_INTERVAL']} seconds")
+    return thread
+
+def increment_metric(name, amount=1):
+    """Add to one of the counters reported by /metrics"""
+    with _metrics_lock:
+        metrics[name] = metrics.get(name, 0) + amount
+
+def acquire_pipeline_slot(count=1):
+    """Wait in the bounded queue for count pipeline slots, taken all at once.
+
+    Returns False straight away when the queue is full, or once the configured
+    wait has passed, so the caller can answer 503 instead of tying up a worker.
+    """
+    with _pipeline_slots:
+        if _pipeline_state['active'] + count <= app.config['MAX_CONCURRENT_PIPELINES'] and _pipeline_state['queued'] == 0:
+            _pipeline_state['active'] += count
+            increment_metric('pipelines_admitted')
+            return True
+        
+        if _pipeline_state['queued'] >= app.config['MAX_PIPELINE_QUEUE']:
+            increment_metric('pipelines_rejected')
+            return False
+        
+        _pipeline_state['queued'] += 1
+        deadline = time.monotonic() + app.config['PIPELINE_QUEUE_TIMEOUT']
+        try:
+            while _pipeline_state['active'] + count > app.config['MAX_CONCURRENT_PIPELINES']:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    increment_metric('pipelines_timed_out')
+                    return False
+                _pipeline_slots.wait(remaining)
+            _pipeline_state['active'] += count
+            increment_metric('pipelines_admitted')
+            return True
+        finally:
+            _pipeline_state['queued'] -= 1
+
+def release_pipeline_slot(count=1):
+    """Give pipeline slots back and wake the queued uploads"""
+    with _pipeline_slots:
+        _pipeline_state['active'] -= count
+        # Waiters may need different numbers of slots, so let each of them re-check
+        _pipeline_slots.notify_all()
+
+def pipeline_status():
+    """Current pipeline load, as reported by /metrics and busy responses"""
+    with _pipeline_slots:
+        return {
+            'active': _pipeline_state['active'],
+            'queued': _pipeline_state['queued'],
+            'max_concurrent': app.config['MAX_CONCURRENT_PIPELINES'],
+            'max_queue': app.config['MAX_PIPELINE_QUEUE'],
+        }
+
+def pipeline_busy_response():
+    """503 telling the client when to retry an upload that could not be admitted"""
+    retry_after = app.config['PIPELINE_RETRY_AFTER']
+    response = jsonify({
+        'error': f'The server is busy processing other menus. Please try again in {retry_after} seconds.',
+        'queue': pipeline_status(),
+        'retry_after': retry_after
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+class _ZipStreamBuffer:
+    """Write-only, unseekable file object that collects what zipfile writes until it is drained"""
+    
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self._offset
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+ZIP_STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg')  # already compressed, so stored as-is
+ZIP_CHUNK_SIZE = 64 * 1024
+
+def stream_menu_zip(images):
+    """Yield a ZIP archive of a menu's images chunk by chunk.
+
+    Only one chunk of one image is held in memory at a time, whatever the
+    number of images, and the first bytes are sent before any image is read
+    completely.
+    """
+    buffer = _ZipStreamBuffer()
+    used_names = set()
+    with zipfile.ZipFile(buffer, mode='w') as archive:
+        for image in images:
+            path = os.path.join(app.config['OUTPUT_FOLDER'], image['filename'])
+            if not os.path.isfile(path):
+                logger.warning(f"Skipping missing image in export: {image['filename']}")
+                continue
+            
+            extension = os.path.splitext(image['filename'])[1].lower()
+            base_name = sanitize_filename(image['dish']) or 'dish'
+            name = f"{base_name}{extension}"
+            suffix = 2
+            while name in used_names:
+                name = f"{base_name}_{suffix}{extension}"
+                suffix += 1
+            used_names.add(name)
+            
+            info = zipfile.ZipInfo(name, date_time=time.localtime(os.path.getmtime(path))[:6])
+            info.compress_type = zipfile.ZIP_STORED if extension in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            record_access('dishes', image['filename'])
+            
+            with open(path, 'rb') as source, archive.open(info, 'w') as entry:
+                while True:
+                    chunk = source.read(ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    entry.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            
+            data = buffer.drain()  # data descriptor of the finished entry
+            if data:
+                yield data
+    
+    yield buffer.drain()  # central directory
+
+def get_thumbnail(filename, size):
+    """Path of a cached thumbnail of a dish image, rebuilt only when the source image is newer"""
+    source_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
+    thumb_folder = os.path.join(app.config['CACHE_FOLDER'], 'thumbs')
+    thumb_path = os.path.join(thumb_folder, f"{os.path.splitext(filename)[0]}_{size}.png")
+    if os.path.exists(thumb_path) and os.path.getmtime(thumb_path) >= os.path.getmtime(source_path):
+        return thumb_path
+    
+    os.makedirs(thumb_folder, exist_ok=True)
+    with Image.open(source_path) as img:
+        img.draft('RGB', (size, size))  # JPEG sources are decoded at reduced scale
+        thumb = img.convert('RGB')
+        thumb.thumbnail((size, size))
+        tmp_path = f"{thumb_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        thumb.save(tmp_path, format='PNG')
+    os.replace(tmp_path, thumb_path)
+    return thumb_path
+
+def _caption_font(size):
+    try:
+        return ImageFont.truetype('DejaVuSans.ttf', size)
+    except OSError:
+        return ImageFont.load_default()
+
+def _composite_geometry(layout, count, size):
+    """Canvas size and the top-left corner of every cell for a composite layout"""
+    padding = max(8, size // 16)
+    if layout == 'list':
+        # One row per dish: thumbnail on the left, name on the right
+        cell_width, cell_height = size * 3, size
+        columns = 1
+    else:
+        cell_width, cell_height = size, size + size // 6
+        columns = max(1, math.ceil(math.sqrt(count)))
+    rows = max(1, math.ceil(count / columns))
+    
+    cells = []
+    for index in range(count):
+        row, column = divmod(index, columns)
+        cells.append((padding + column * (cell_width + padding), padding + row * (cell_height + padding)))
+    canvas_size = (padding + columns * (cell_width + padding), padding + rows * (cell_height + padding))
+    return canvas_size, cells, (cell_width, cell_height)
+
+def _composite_path_lock(composite_path):
+    with _composite_locks_lock:
+        return _composite_locks.setdefault(composite_path, threading.Lock())
+
+def _composite_thumbnail(image, size):
+    """Thumbnail path for one composite cell, or None if the dish image cannot be read"""
+    try:
+        return get_thumbnail(image['filename'], size)
+    except Exception as e:
+        logger.warning(f"No thumbnail for {image['filename']}: {e}")
+        return None
+
+def _composite_changed_cells(composite_path, manifest_path, signatures):
+    """Indices of the cells the cached composite does not show yet, or None if there is no usable cached composite"""
+    if not (os.path.exists(composite_path) and os.path.exists(manifest_path)):
+        return None
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading composite manifest: {e}")
+        return None
+    if len(manifest.get('cells', [])) != len(signatures):
+        return None
+    return [index for index, signature in enumerate(signatures) if manifest['cells'][index] != signature]
+
+def _draw_composite_cell(canvas, layout, origin, cell_size, size, image, thumb_path):
+    """Draw one dish's thumbnail and name into its cell, replacing whatever was there"""
+    draw = ImageDraw.Draw(canvas)
+    x, y = origin
+    draw.rectangle([x, y, x + cell_size[0] - 1, y + cell_size[1] - 1], fill='white')
+    
+    pasted = False
+    if thumb_path:
+        try:
+            with Image.open(thumb_path) as thumb:
+                thumb_x = x + (size - thumb.width) // 2
+                thumb_y = y + (size - thumb.height) // 2
+                canvas.paste(thumb, (thumb_x, thumb_y))
+            pasted = True
+        except Exception as e:
+            logger.warning(f"No thumbnail for {image['filename']}: {e}")
+    if not pasted:
+        draw.rectangle([x, y, x + size - 1, y + size - 1], fill='#eeeeee')
+    
+    if layout == 'list':
+        font = _caption_font(max(12, size // 6))
+        text_origin, max_width = (x + size + size // 8, y + size // 2), cell_size[0] - size - size // 4
+        anchor = 'lm'
+    else:
+        font = _caption_font(max(10, size // 10))
+        text_origin, max_width = (x + size // 2, y + size + (cell_size[1] - size) // 2), size
+        anchor = 'mm'
+    
+    caption, ellipsis = image['dish'], '…'
+    bitmap_font = not isinstance(font, ImageFont.FreeTypeFont)
+    if bitmap_font:
+        # The bitmap fallback font only covers Latin-1 and has no anchor support
+        caption, ellipsis = caption.encode('latin-1', 'replace').decode('latin-1'), '...'
+    if draw.textlength(caption, font=font) > max_width:
+        while caption and draw.textlength(caption + ellipsis, font=font) > max_width:
+            caption = caption[:-1]
+        caption += ellipsis
+    
+    if bitmap_font:
+        left, top, right, bottom = draw.textbbox((0, 0), caption, font=font)
+        offset_x = 0 if anchor == 'lm' else (right - left) // 2
+        draw.text((text_origin[0] - offset_x, text_origin[1] - (bottom - top) // 2), caption, fill='#333333', font=font)
+    else:
+        draw.text(text_origin, caption, fill='#333333', font=font, anchor=anchor)
+
+def render_menu_composite(file_hash, images, layout, size):
+    """Render (or reuse) the illustrated-menu composite for one menu, layout and thumbnail size.
+
+    The composite is cached together with a manifest of what each cell shows.
+    When only some dish images changed (for example a draft upgraded to the
+    final tier) just those cells are redrawn; when nothing changed the cached
+    file is returned untouched.
+    """
+    composite_folder = os.path.join(app.config['CACHE_FOLDER'], 'composites')
+    composite_path = os.path.join(composite_folder, f"{file_hash}_{layout}_{size}.png")
+    manifest_path = f"{os.path.splitext(composite_path)[0]}.json"
+    
+    signatures = []
+    for image in images:
+        source_path = os.path.join(app.config['OUTPUT_FOLDER'], image['filename'])
+        mtime = os.stat(source_path).st_mtime_ns if os.path.exists(source_path) else 'missing'
+        signatures.append(f"{image['dish']}|{image['filename']}|{mtime}")
+    
+    canvas_size, cells, cell_size = _composite_geometry(layout, len(images), size)
+    
+    # The manifest is written atomically, so the cells to redraw can be found without the lock
+    changed = _composite_changed_cells(composite_path, manifest_path, signatures)
+    if changed == []:
+        return composite_path
+    
+    # Decoding dish images is the slow part, so thumbnails are built before locking the file
+    thumbs = {index: _composite_thumbnail(images[index], size) for index in (range(len(images)) if changed is None else changed)}
+    
+    with _composite_path_lock(composite_path):
+        # Another request may have redrawn the file meanwhile
+        changed = _composite_changed_cells(composite_path, manifest_path, signatures)
+        if changed == []:
+            return composite_path
+        if changed is None:
+            changed = range(len(images))
+            canvas = Image.new('RGB', canvas_size, 'white')
+        else:
+            logger.info(f"Redrawing {len(changed)} of {len(signatures)} cells of {layout} composite for {file_hash[:12]}")
+            with Image.open(composite_path) as cached:
+                canvas = cached.convert('RGB')
+        
+        for index in changed:
+            thumb_path = thumbs[index] if index in thumbs else _composite_thumbnail(images[index], size)
+            _draw_composite_cell(canvas, layout, cells[index], cell_size, size, images[index], thumb_path)
+        
+        os.makedirs(composite_folder, exist_ok=True)
+        tmp_path = f"{composite_path}.{os.getpid()}.tmp"
+        canvas.save(tmp_path, format='PNG')
+        os.replace(tmp_path, composite_path)
+        write_json_atomically(manifest_path, {'cells': signatures})
+    
+    return composite_path
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -246,6 +1618,12 @@ def upload_file():
         return jsonify({'error': 'No file provided'})
     
     file = request.files['file']
+    tier = request.form.get('tier', app.config['DEFAULT_IMAGE_TIER'])
+    style = request.form.get('style', DEFAULT_PROMPT_STYLE)
+    progressive = request.form.get('progressive') == '1'
+    if tier not in IMAGE_TIERS or style not in PROMPT_STYLES:
+        return jsonify({'error': f'Unknown image tier or style: {tier}, {style}'})
+    
     if file.filename == '':
         return jsonify({'error': 'No file selected'})
     
@@ -263,10 +1641,12 @@ def upload_file():
             
             if previous_upload:
                 logger.info(f"File previously uploaded {previous_upload['upload_count']} times, returning cached results")
+                # Serve the best tier cached by now (drafts may have been upgraded since)
+                cached_images = refresh_image_tiers(previous_upload['generated_images'])
                 return jsonify({
                     'dishes': previous_upload['dishes'],
-                    'generated_images': previous_upload['generated_images'],
-                    'total_generated': len(previous_upload['generated_images']),
+                    'generated_images': cached_images,
+                    'total_generated': len(cached_images),
                     'skipped_images': [],
                     'total_skipped': 0,
                     'original_image': {
@@ -274,102 +1654,360 @@ def upload_file():
                         'path': f'/upload/{filename}'
                     },
                     'cached': True,
+                    'menu_hash': file_hash,
                     'upload_count': previous_upload['upload_count']
                 })
             
-            # Extract dishes from the uploaded image
-            logger.info("Starting dish extraction...")
-            result = extract_dishes(filepath)
-            
-            if 'error' in result:
-                logger.error(f"Dish extraction failed: {result['error']}")
-                return jsonify(result)
-            
-            dishes = result['dishes']
-            
-            if not dishes:
-                logger.warning("No dishes found")
-                return jsonify({'error': 'No dishes found in the menu image'})
-            
-            logger.info(f"Found {len(dishes)} dishes, checking existing images...")
-            
-            # List existing files for debugging
-            existing_files = os.listdir(app.config['OUTPUT_FOLDER'])
-            logger.info(f"Existing files in dishes folder: {existing_files}")
+            # Only a bounded number of menus are processed at once; the rest queue or get a 503
+            if not acquire_pipeline_slot():
+                logger.warning("Upload rejected: pipeline queue is full")
+                return pipeline_busy_response()
             
-            # Generate images for each dish (skip if already exists)
-            generated_images = []
-            skipped_images = []
-            
-            for i, dish in enumerate(dishes):
-                logger.info(f"Processing dish {i+1}/{len(dishes)}: {dish}")
+            try:
+                # Extract dishes from the uploaded image, resolving images as dishes stream in
+                logger.info("Starting dish extraction...")
+                extraction = {}
+                try:
+                    dishes, generated_images, skipped_images, failed_images = process_menu_dishes(
+                        checkpointed_dishes(file_hash, filename, filepath, extraction), tier, style, progressive, file_hash
+                    )
+                except ExtractionError as e:
+                    logger.error(f"Dish extraction failed: {e}")
+                    clear_checkpoint(file_hash)
+                    return jsonify({'error': str(e)})
                 
-                # Try to find existing image with various naming patterns
-                existing_filename, existing_path = find_existing_image(dish, app.config['OUTPUT_FOLDER'])
+                if not dishes:
+                    logger.warning("No dishes found")
+                    clear_checkpoint(file_hash)
+                    return jsonify({'error': 'No dishes found in the menu image'})
                 
-                if existing_filename and existing_path:
-                    logger.info(f"Image already exists for: {dish} at {existing_path}")
-                    skipped_images.append({
-                        'dish': dish,
-                        'filename': existing_filename,
-                        'path': f'/image/{existing_filename}',
-                        'status': 'existing'
-                    })
-                    generated_images.append({
-                        'dish': dish,
-                        'filename': existing_filename,
-                        'path': f'/image/{existing_filename}'
-                    })
-                else:
-                    logger.info(f"Generating new image for: {dish}")
-                    # Create consistent filename for new images
-                    sanitized_dish = sanitize_filename(dish)
-                    filename = f"{sanitized_dish}.png"
-                    output_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-                    
-                    success = generate_image_with_openai(dish, output_path)
-                    if success:
-                        generated_images.append({
-                            'dish': dish,
-                            'filename': filename,
-                            'path': f'/image/{filename}'
-                        })
-                        logger.info(f"Successfully generated image for: {dish}")
-                    else:
-                        logger.error(f"Failed to generate image for: {dish}")
+                logger.info(f"Completed processing. Generated {len(generated_images)} images, skipped {len(skipped_images)} existing images")
                 
-                time.sleep(2)  # Rate limiting
+                # Record this upload in history, unless part of the menu is missing and the next upload should retry it
+                incomplete = extraction.get('incomplete', False)
+                if file_hash:
+                    if not incomplete:
+                        record_upload(file_hash, filename, dishes, generated_images)
+                    clear_checkpoint(file_hash)
+                
+                return jsonify({
+                    'dishes': dishes,
+                    'generated_images': generated_images,
+                    'total_generated': len(generated_images),
+                    'skipped_images': skipped_images,
+                    'total_skipped': len(skipped_images),
+                    'failed_images': failed_images,
+                    'total_failed': len(failed_images),
+                    'original_image': {
+                        'filename': filename,
+                        'path': f'/upload/{filename}'
+                    },
+                    'cached': False,
+                    'incomplete': incomplete,
+                    'menu_hash': file_hash
+                })
+            finally:
+                release_pipeline_slot()
             
-            logger.info(f"Completed processing. Generated {len(generated_images)} images, skipped {len(skipped_images)} existing images")
+        except Exception as e:
+            logger.error(f"Error in upload_file: {e}")
+            return jsonify({'error': f'Server error: {str(e)}'})
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Process many menus in one request, generating each dish they share only once"""
+    logger.info("Batch upload request received")
+    
+    files = [file for file in request.files.getlist('files') if file.filename]
+    if not files:
+        return jsonify({'error': 'No files uploaded'})
+    if len(files) > app.config['MAX_BATCH_FILES']:
+        return jsonify({'error': f"At most {app.config['MAX_BATCH_FILES']} menus per batch"})
+    
+    tier = request.form.get('tier', app.config['DEFAULT_IMAGE_TIER'])
+    style = request.form.get('style', DEFAULT_PROMPT_STYLE)
+    progressive = request.form.get('progressive') == '1'
+    if tier not in IMAGE_TIERS or style not in PROMPT_STYLES:
+        return jsonify({'error': f'Unknown image tier or style: {tier}, {style}'})
+    
+    try:
+        menus = []  # (file_hash, filename, filepath) in upload order
+        rejected = {}  # filename -> error, for menus that are not processed at all
+        for file in files:
+            filename = secure_filename(file.filename)
+            if any(filename == menu[1] for menu in menus):
+                # Same name, different menu: keep both files on disk
+                stem, ext = os.path.splitext(filename)
+                filename = f"{stem}_{len(menus)}{ext}"
             
-            # Record this upload in history
-            if file_hash:
-                record_upload(file_hash, filename, dishes, generated_images)
+            file.stream.seek(0, os.SEEK_END)
+            size = file.stream.tell()
+            file.stream.seek(0)
+            if size > app.config['MAX_CONTENT_LENGTH']:
+                rejected[filename] = f"Menu is larger than {app.config['MAX_CONTENT_LENGTH'] / (1024 * 1024):g} MB"
+                menus.append((None, filename, None))
+                continue
             
-            return jsonify({
-                'dishes': dishes,
-                'generated_images': generated_images,
-                'total_generated': len(generated_images),
-                'skipped_images': skipped_images,
-                'total_skipped': len(skipped_images),
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            file.save(filepath)
+            menus.append((get_file_hash(filepath), filename, filepath))
+        logger.info(f"Saved {len(menus)} batch menus")
+        
+        # Menus seen before are answered from history; the rest are extracted once per distinct file
+        to_process = {}
+        for file_hash, filename, filepath in menus:
+            if file_hash and not check_previous_upload(file_hash):
+                to_process.setdefault(file_hash, (file_hash, filename, filepath))
+        
+        results, unique_dishes = {}, 0
+        if to_process:
+            # A batch counts as one pipeline per menu it extracts at once, within the global limit
+            slots = max(1, min(len(to_process), app.config['BATCH_EXTRACTION_WORKERS'], app.config['MAX_CONCURRENT_PIPELINES']))
+            if not acquire_pipeline_slot(slots):
+                logger.warning("Batch upload rejected: pipeline queue is full")
+                return pipeline_busy_response()
+            try:
+                results, unique_dishes = process_menu_batch(list(to_process.values()), tier, style, progressive, slots)
+            finally:
+                release_pipeline_slot(slots)
+            
+            for file_hash, (_, filename, _) in to_process.items():
+                result = results[file_hash]
+                if 'error' not in result and not result['incomplete']:
+                    record_upload(file_hash, filename, result['dishes'], result['generated_images'])
+                clear_checkpoint(file_hash)
+        
+        menu_results = []
+        for file_hash, filename, _ in menus:
+            if filename in rejected:
+                # Rejected menus were never saved, so there is no original image to link to
+                menu_results.append({'filename': filename, 'menu_hash': None, 'error': rejected[filename]})
+                continue
+            
+            menu_result = {
                 'original_image': {
                     'filename': filename,
                     'path': f'/upload/{filename}'
                 },
-                'cached': False
-            })
-            
-        except Exception as e:
-            logger.error(f"Error in upload_file: {e}")
-            return jsonify({'error': f'Server error: {str(e)}'})
+                'menu_hash': file_hash
+            }
+            if not file_hash:
+                menu_result['error'] = 'Could not read uploaded file'
+            elif file_hash in results:
+                result = results[file_hash]
+                menu_result.update(result)
+                if 'error' not in result:
+                    menu_result.update({
+                        'total_generated': len(result['generated_images']),
+                        'total_skipped': len(result['skipped_images']),
+                        'total_failed': len(result['failed_images']),
+                        'cached': False
+                    })
+            else:
+                previous_upload = check_previous_upload(file_hash)
+                cached_images = refresh_image_tiers(previous_upload['generated_images'])
+                menu_result.update({
+                    'dishes': previous_upload['dishes'],
+                    'generated_images': cached_images,
+                    'total_generated': len(cached_images),
+                    'skipped_images': [],
+                    'total_skipped': 0,
+                    'cached': True,
+                    'upload_count': previous_upload['upload_count']
+                })
+            menu_results.append(menu_result)
+        
+        logger.info(f"Completed batch: {len(menus)} menus, {unique_dishes} unique dishes resolved")
+        return jsonify({
+            'menus': menu_results,
+            'total_menus': len(menu_results),
+            'unique_dishes': unique_dishes
+        })
+    
+    except Exception as e:
+        logger.error(f"Error in upload_batch: {e}")
+        return jsonify({'error': f'Server error: {str(e)}'})
+
+@app.route('/metrics')
+def metrics_view():
+    """Pipeline queue depth and counters, cheap enough to poll under load"""
+    with _metrics_lock:
+        counters = dict(metrics)
+    return jsonify({
+        'pipelines': pipeline_status(),
+        'counters': counters,
+        'extraction_hedge_delay': extraction_hedge_delay() if app.config['EXTRACTION_HEDGE'] else None,
+    })
+
+@app.route('/best-image')
+def best_image():
+    """Best cached tier for a dish, polled by the UI while a draft is being upgraded"""
+    dish = request.args.get('dish', '')
+    style = request.args.get('style', DEFAULT_PROMPT_STYLE)
+    target_tier = request.args.get('tier', app.config['DEFAULT_IMAGE_TIER'])
+    if not dish or style not in PROMPT_STYLES or target_tier not in IMAGE_TIERS:
+        return jsonify({'error': 'A dish and a valid style and tier are required'}), 400
+    
+    filename, _, tier = find_best_cached_image(dish, style)
+    if not filename:
+        return jsonify({'error': f'No cached image for: {dish}'}), 404
+    
+    image = image_entry(dish, filename, tier, style)
+    image['upgrading'] = is_upgrade_pending(dish, target_tier, style)
+    return jsonify(image)
+
+@app.route('/menus/<file_hash>/export.zip')
+def export_menu_zip(file_hash):
+    """Download every image of a previously processed menu as one streamed ZIP"""
+    previous_upload = check_previous_upload(file_hash)
+    if not previous_upload:
+        return jsonify({'error': 'Unknown menu'}), 404
+    
+    images = refresh_image_tiers(previous_upload['generated_images'])
+    download_name = f"{os.path.splitext(previous_upload['filename'])[0] or 'menu'}_images.zip"
+    return Response(
+        stream_with_context(stream_menu_zip(images)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{download_name}"'}
+    )
+
+@app.route('/menus/<file_hash>/composite.png')
+def menu_composite(file_hash):
+    """Illustrated menu: every dish image of a processed menu laid out on one sheet"""
+    layout = request.args.get('layout', 'grid')
+    size = request.args.get('size', 256, type=int)
+    if layout not in COMPOSITE_LAYOUTS or size not in THUMBNAIL_SIZES:
+        return jsonify({'error': f'Layout must be one of {COMPOSITE_LAYOUTS} and size one of {THUMBNAIL_SIZES}'}), 400
+    
+    previous_upload = check_previous_upload(file_hash)
+    if not previous_upload or not previous_upload['generated_images']:
+        return jsonify({'error': 'Unknown menu'}), 404
+    
+    images = refresh_image_tiers(previous_upload['generated_images'])
+    return send_file(render_menu_composite(file_hash, images, layout, size), mimetype='image/png')
+
+@app.route('/thumbnail/<int:size>/<filename>')
+def serve_thumbnail(size, filename):
+    if size not in THUMBNAIL_SIZES:
+        return jsonify({'error': f'Size must be one of {THUMBNAIL_SIZES}'}), 400
+    if not os.path.isfile(os.path.join(app.config['OUTPUT_FOLDER'], secure_filename(filename))):
+        return jsonify({'error': 'Unknown image'}), 404
+    record_access('dishes', secure_filename(filename))
+    return send_file(get_thumbnail(secure_filename(filename), size), mimetype='image/png')
 
 @app.route('/image/<filename>')
 def serve_image(filename):
-    return send_file(os.path.join(app.config['OUTPUT_FOLDER'], filename))
+    path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
+    if not os.path.isfile(path):  # 404s and probes must not add access-log keys
+        return jsonify({'error': 'Unknown image'}), 404
+    record_access('dishes', filename)
+    return send_file(path)
 
 @app.route('/upload/<filename>')
 def serve_upload(filename):
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if not os.path.isfile(path):
+        return jsonify({'error': 'Unknown upload'}), 404
+    record_access('uploads', filename)
+    return send_file(path)
+
+@app.cli.command('collect-garbage')
+def collect_garbage_command():
+    """Run one disk garbage collection pass now."""
+    evicted = collect_garbage()
+    click.echo(f"Evicted {len(evicted['uploads'])} uploads, {len(evicted['dishes'])} dish images and {len(evicted['cache'])} cached thumbnails/composites")
+
+def load_dish_catalog(catalog_path):
+    """Load a dish catalog: a JSON list of names, a JSON object of name -> weight, or one name per line"""
+    with open(catalog_path, 'r') as f:
+        content = f.read()
+    
+    try:
+        catalog = json.loads(content)
+    except json.JSONDecodeError:
+        catalog = [line.strip() for line in content.split('\n') if line.strip()]
+    
+    if isinstance(catalog, dict):
+        return {str(dish): float(weight) for dish, weight in catalog.items()}
+    return {str(dish): 1.0 for dish in catalog}
+
+def rank_popular_dishes(history, catalog=None):
+    """Rank dishes by how often they appear across upload history and an optional catalog.
+
+    Each menu counts once per upload, so frequently re-uploaded menus weigh more.
+    Returns (dish, score) pairs, most popular first.
+    """
+    scores = {}
+    names = {}
+    
+    def add(dish, weight):
+        key = normalize_dish_name(dish)
+        if not key:
+            return
+        scores[key] = scores.get(key, 0) + weight
+        names.setdefault(key, dish)
+    
+    for entry in history.values():
+        weight = entry.get('upload_count', 1)
+        menu_dishes = {normalize_dish_name(dish): dish for dish in entry.get('dishes', [])}
+        for dish in menu_dishes.values():
+            add(dish, weight)
+    
+    for dish, weight in (catalog or {}).items():
+        add(dish, weight)
+    
+    ranked = sorted(scores, key=lambda key: (-scores[key], key))
+    return [(names[key], scores[key]) for key in ranked]
+
+@app.cli.command('warm-cache')
+@click.option('--top', default=50, show_default=True, help='Generate images for at most this many missing dishes.')
+@click.option('--catalog', 'catalog_path', type=click.Path(exists=True, dir_okay=False), help='Extra dishes to rank: JSON list, JSON object of weights, or one name per line.')
+@click.option('--tier', default='final', show_default=True, type=click.Choice(TIER_ORDER), help='Image quality tier to pre-generate.')
+@click.option('--style', default=DEFAULT_PROMPT_STYLE, show_default=True, type=click.Choice(list(PROMPT_STYLES)), help='Prompt style to pre-generate.')
+@click.option('--max-cost', default=5.0, show_default=True, help='Stop before the estimated spend exceeds this many USD.')
+@click.option('--rate', default=5.0, show_default=True, help='Maximum images generated per minute.')
+@click.option('--dry-run', is_flag=True, help='Only list the dishes that would be generated.')
+def warm_cache_command(top, catalog_path, tier, style, max_cost, rate, dry_run):
+    """Pre-generate images for the most popular dishes that are not cached yet."""
+    catalog = load_dish_catalog(catalog_path) if catalog_path else None
+    ranked = rank_popular_dishes(load_upload_history(), catalog)
+    missing = [(dish, score) for dish, score in ranked if not find_cached_image(dish, tier, style)[0]]
+    click.echo(f"{len(ranked)} known dishes, {len(missing)} without a cached {tier} image")
+    failing = [dish for dish, _ in missing if active_generation_failure(dish)]
+    if failing:
+        click.echo(f"Skipping {len(failing)} dishes whose generation failed recently")
+        missing = [(dish, score) for dish, score in missing if dish not in failing]
+    
+    cost_per_image = IMAGE_TIERS[tier]['cost']
+    spent = 0.0
+    generated = 0
+    failed = 0
+    for dish, score in missing[:top]:
+        if spent + cost_per_image > max_cost:
+            click.echo(f"Stopping: cost budget of ${max_cost:.2f} reached")
+            break
+        
+        if dry_run:
+            click.echo(f"Would generate {dish} (score {score:g})")
+            spent += cost_per_image
+            continue
+        
+        started = time.monotonic()
+        spent += cost_per_image
+        if generate_dish_image(dish, tier, style):
+            generated += 1
+            click.echo(f"Generated {dish} (score {score:g})")
+        else:
+            failed += 1
+            click.echo(f"Failed to generate {dish}")
+        
+        # Keep to the requested rate on top of the shared API budget
+        if rate > 0:
+            time.sleep(max(0.0, 60.0 / rate - (time.monotonic() - started)))
+    
+    click.echo(f"Done: {generated} generated, {failed} failed, estimated cost ${spent:.2f}")
+
+start_disk_gc()
 
 if __name__ == '__main__':
     # Get port from environment variable or default to 5051